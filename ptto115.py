@@ -1,62 +1,458 @@
+import hashlib
+import logging
+import mmap
 import os
+import queue
+import shutil
+import sqlite3
+import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 import requests
+import xxhash
 from dotenv import load_dotenv
+from inotify_simple import INotify, flags
 from p115client.client import P115Client
+from p115client.exception import AuthenticationError
 from p115client.tool.upload import multipart_upload_init
 
-# 加载.env文件中的环境变量
-load_dotenv()
+version = "1.0.4"
+logger = logging.getLogger("ptto115")
+
 
 # ======================== 环境变量配置（从.env文件读取） ========================
-# 115客户端配置
-version = "1.0.4"
-TG_BOT_TOKEN = os.getenv("ENV_TG_BOT_TOKEN", "")
-TG_ADMIN_USER_ID = int(os.getenv("ENV_TG_ADMIN_USER_ID", "0"))
-TRY_MAX_COUNT = int(os.getenv("ENV_TRY_MAX_COUNT", "999999"))
-try:
-    # 读取115 cookies
-    COOKIES = os.getenv("ENV_115_COOKIES", "")
-
-    # 读取上传目标目录ID
-    UPLOAD_TARGET_PID = int(os.getenv("ENV_115_UPLOAD_PID", "0"))
-
-except (ValueError, TypeError) as e:
-    # 环境变量值格式错误或未设置
-    print(f"环境变量错误：{e}")
-    print("请确保.env文件中已正确设置所有必要的环境变量")
-    # 终止程序，因为缺少必要的环境变量
-    exit(1)
+@dataclass(frozen=True, slots=True)
+class Config:
+    """运行配置，启动时从环境变量读取一次，之后以参数形式传递"""
+    cookies: str  # 115 cookies
+    upload_pid: int  # 上传目标目录ID
+    tg_bot_token: str  # Telegram机器人token
+    tg_admin_user_id: int  # Telegram用户ID
+    try_max_count: int  # 最大尝试次数
+
+    @property
+    def tg_enabled(self):
+        """是否配置了Telegram通知"""
+        return bool(self.tg_bot_token and self.tg_admin_user_id)
+
+
+def load_config():
+    """加载.env文件并解析环境变量，格式错误时终止程序"""
+    load_dotenv()
+    try:
+        return Config(
+            cookies=os.getenv("ENV_115_COOKIES", ""),
+            upload_pid=int(os.getenv("ENV_115_UPLOAD_PID", "0")),
+            tg_bot_token=os.getenv("ENV_TG_BOT_TOKEN", ""),
+            tg_admin_user_id=int(os.getenv("ENV_TG_ADMIN_USER_ID", "0")),
+            try_max_count=int(os.getenv("ENV_TRY_MAX_COUNT", "999999")),
+        )
+    except (ValueError, TypeError) as e:
+        # 环境变量值格式错误或未设置
+        logger.error("环境变量错误：%s", e)
+        logger.error("请确保.env文件中已正确设置所有必要的环境变量")
+        # 终止程序，因为缺少必要的环境变量
+        exit(1)
+
 
 # ======================== 其他固定配置 ========================
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "upload")  # 待上传目录
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))  # 脚本所在目录
+UPLOAD_DIR = os.path.join(SCRIPT_DIR, "upload")  # 待上传目录
+TRANSFER_DIR = os.path.join(SCRIPT_DIR, "transfer")  # 超过最大尝试次数后文件移动的目录
 SLEEP_AFTER_FILE = 10  # 单个文件处理后休眠（秒）
 SLEEP_AFTER_ROUND = 60  # 一轮遍历后休眠（秒）
+FULL_RESCAN_INTERVAL = 3600  # 启用inotify时全量扫描待上传目录的间隔（秒），用于校正遗漏的事件
+SIZE_CHECK_INTERVAL = 30  # 回退的文件大小检查间隔（秒），超过两倍间隔未修改的文件直接视为已写完
+RETRY_BACKOFF_MIN = 5  # 上传接口网络/服务端错误后的初始退避时间（秒）
+RETRY_BACKOFF_MAX = 60  # 退避时间上限（秒）
+TG_MESSAGE_MAX_LEN = 4096  # Telegram单条消息最大长度
+QUICK_FINGERPRINT_BLOCK = 64 << 10  # 快速指纹读取文件首尾的字节数
+CACHE_DB_PATH = os.path.join(SCRIPT_DIR, ".ptto115.cache.db")  # SHA1缓存数据库
+NETWORK_FS_TYPES = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "9p"}  # inotify无法感知远端写入的文件系统
 
 
 # ======================== 工具函数 ========================
-def check_file_size_stability(file_path, check_interval=30, max_attempts=1000):
-    """检查文件大小稳定性，防止文件不完整"""
-    for attempt in range(max_attempts):
-        size1 = os.path.getsize(file_path)
+def iter_files(root):
+    """基于os.scandir递归遍历目录，逐个产出文件（含指向文件的符号链接）的DirEntry（复用目录项元数据，减少stat调用）"""
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from iter_files(entry.path)
+                elif entry.is_file():
+                    yield entry
+    except OSError as e:
+        logger.warning("遍历目录失败：%s → %s", root, e)
+
+
+def is_idle(st_mtime, check_interval=SIZE_CHECK_INTERVAL):
+    """文件是否已超过两倍检查间隔未修改（如启动前积压的文件），此时可直接视为已写完"""
+    return time.time() - st_mtime > 2 * check_interval
+
+
+def is_file_size_stable(file_path, check_interval=SIZE_CHECK_INTERVAL):
+    """回退方案：间隔读取两次文件大小，相同则认为文件已写完（用于inotify无法感知写入的场景）"""
+    try:
+        stat = os.stat(file_path)
+        # 长时间未修改的文件直接视为已写完，无需等待
+        if is_idle(stat.st_mtime, check_interval):
+            logger.info("文件已超过 %s 秒未修改，视为大小稳定：%s", 2 * check_interval, file_path)
+            return True
+        size1 = stat.st_size
         time.sleep(check_interval)
         size2 = os.path.getsize(file_path)
-        if size1 == size2:
-            print(f"[信息] 文件大小稳定：{file_path}")
-            return True
-        print(f"[警告] 文件大小不稳定，第 {attempt + 1} 次检查：{file_path}")
-    print(f"[错误] 文件大小不稳定，放弃上传：{file_path}")
+    except FileNotFoundError:
+        logger.info("文件已删除：%s", file_path)
+        return False
+    if size1 == size2:
+        logger.info("文件大小稳定：%s", file_path)
+        return True
+    logger.warning("文件大小不稳定，下一轮再检查：%s", file_path)
     return False
 
 
-def init_115_client():
+def sha1_file(file_path, use_mmap=True, bufsize=1 << 20):
+    """计算文件SHA1（hashlib底层由OpenSSL实现，支持SHA-NI硬件加速），返回115接口使用的大写十六进制"""
+    h = hashlib.sha1()
+    with open(file_path, "rb", buffering=0) as f:
+        # 优先mmap映射后以memoryview切片喂给hashlib，省去每块数据拷贝到bytes对象；
+        # 可能被并发截断的文件（会触发SIGBUS）、空文件及32位平台上的超大文件改用流式读取
+        filesize = os.fstat(f.fileno()).st_size
+        if use_mmap and 0 < filesize <= sys.maxsize:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+            except (OSError, ValueError):
+                mm = None
+            if mm is not None:
+                with mm, memoryview(mm) as mv:
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    step = 4 << 20
+                    for offset in range(0, len(mv), step):
+                        h.update(mv[offset:offset + step])
+                return h.hexdigest().upper()
+
+        if hasattr(os, "posix_fadvise"):
+            # 提示内核顺序读取，加大预读
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for chunk in iter(lambda: f.read(bufsize), b""):
+            h.update(chunk)
+    return h.hexdigest().upper()
+
+
+def quick_fingerprint(file_path):
+    """以文件大小及首尾各64KiB计算xxh3_64快速指纹，返回有符号64位整数（便于存入SQLite）"""
+    h = xxhash.xxh3_64()
+    with open(file_path, "rb") as f:
+        filesize = os.fstat(f.fileno()).st_size
+        h.update(filesize.to_bytes(8, "little"))
+        h.update(f.read(QUICK_FINGERPRINT_BLOCK))
+        if filesize > QUICK_FINGERPRINT_BLOCK:
+            f.seek(max(filesize - QUICK_FINGERPRINT_BLOCK, QUICK_FINGERPRINT_BLOCK))
+            h.update(f.read(QUICK_FINGERPRINT_BLOCK))
+    return int.from_bytes(h.digest(), "big", signed=True)
+
+
+def is_write_finished(watcher, file_path):
+    """无需等待即可确认文件已写完：inotify记录其已写完，或长时间未修改"""
+    if watcher is not None:
+        if file_path in watcher.writing:
+            return False
+        if file_path in watcher.completed:
+            return True
+    try:
+        return is_idle(os.stat(file_path).st_mtime)
+    except OSError:
+        return False
+
+
+def can_mmap(watcher, file_path):
+    """是否可用mmap计算SHA1：仅限inotify确认已写完的文件"""
+    # 仅凭修改时间判断已写完的文件若被写入方截断，mmap读取会触发SIGBUS导致整个进程崩溃
+    return watcher is not None and file_path in watcher.completed
+
+
+def is_network_fs(path):
+    """根据/proc/self/mounts判断路径是否位于NFS/SMB等网络文件系统"""
+    try:
+        with open("/proc/self/mounts", encoding="utf-8") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    best_mount, best_type = "", ""
+    for mount_point, fs_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if path == mount_point or path.startswith(mount_point.rstrip("/") + "/"):
+            if len(mount_point) > len(best_mount):
+                best_mount, best_type = mount_point, fs_type
+    return best_type in NETWORK_FS_TYPES
+
+
+class UploadDirWatcher:
+    """基于inotify监控待上传目录，维护目录内文件列表，并区分写入中与已写完（IN_CLOSE_WRITE/IN_MOVED_TO）的文件"""
+
+    WATCH_FLAGS = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE
+                   | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE)
+
+    def __init__(self, root):
+        self.inotify = INotify()
+        self.watches = {}  # {watch描述符: 目录路径}
+        self.files = set()  # 目录内的全部文件
+        self.writing = set()  # 写入中的文件
+        self.completed = set()  # 已写完的文件
+        self.needs_rescan = False  # 事件丢失后需要全量扫描校正文件列表
+        # 根目录监控失败（目录不存在、监控数达到max_user_watches上限等）时抛出OSError，由调用方回退
+        try:
+            self._add_watch(root)
+        except OSError:
+            self.inotify.close()
+            raise
+
+    def _add_watch(self, path):
+        """递归为目录及其子目录添加监控，并记录其中已有的文件（该目录本身监控失败时抛出OSError）"""
+        wd = self.inotify.add_watch(path, self.WATCH_FLAGS)
+        self.watches[wd] = path
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    self._add_subdir_watch(entry.path)
+                elif entry.is_file():
+                    self.files.add(entry.path)
+
+    def _add_subdir_watch(self, path):
+        """为子目录添加监控，失败时（如子目录已被删除）仅记录警告"""
+        try:
+            self._add_watch(path)
+        except OSError as e:
+            logger.warning("添加目录监控失败：%s → %s", path, e)
+
+    def _remove_watch(self, path):
+        """移除目录及其子目录的监控及文件记录（目录被移出监控范围时）"""
+        prefix = path + os.sep
+        for wd, watched in list(self.watches.items()):
+            if watched == path or watched.startswith(prefix):
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+        for file_path in [f for f in self.files if f.startswith(prefix)]:
+            self.files.discard(file_path)
+            self.writing.discard(file_path)
+            self.completed.discard(file_path)
+
+    def reconcile(self, file_paths):
+        """以全量扫描结果校正文件列表（弥补丢失的inotify事件）"""
+        self.files = set(file_paths)
+        self.writing &= self.files
+        self.completed &= self.files
+        self.needs_rescan = False
+
+    def poll(self, timeout=0):
+        """读取并处理inotify事件（timeout单位毫秒），返回是否有新文件出现或文件写完"""
+        has_news = False
+        for event in self.inotify.read(timeout=timeout):
+            if event.mask & flags.Q_OVERFLOW:
+                # 事件队列溢出，已记录的状态不再可信，全部交给回退检查，并在下一轮全量扫描
+                logger.warning("inotify事件队列溢出，重置文件状态")
+                self.writing.clear()
+                self.completed.clear()
+                self.needs_rescan = True
+                continue
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            parent = self.watches.get(event.wd)
+            if parent is None or not event.name:
+                continue
+            path = os.path.join(parent, event.name)
+
+            if event.mask & flags.ISDIR:
+                if event.mask & flags.CREATE:
+                    count = len(self.files)
+                    self._add_subdir_watch(path)
+                    has_news |= len(self.files) > count
+                elif event.mask & flags.MOVED_TO:
+                    # 整个目录移入，目录内文件均已写完
+                    self._add_subdir_watch(path)
+                    for entry in iter_files(path):
+                        self.completed.add(entry.path)
+                        has_news = True
+                elif event.mask & flags.MOVED_FROM:
+                    self._remove_watch(path)
+                continue
+
+            if event.mask & flags.CREATE:
+                # 仅有IN_CREATE时不一定会有写入（如硬链接），交给回退检查判断是否写完
+                has_news |= path not in self.files
+                self.files.add(path)
+                self.completed.discard(path)
+            elif event.mask & flags.MODIFY:
+                self.files.add(path)
+                self.writing.add(path)
+                self.completed.discard(path)
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                self.files.add(path)
+                self.writing.discard(path)
+                self.completed.add(path)
+                has_news = True
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                self.files.discard(path)
+                self.writing.discard(path)
+                self.completed.discard(path)
+        return has_news
+
+    def wait(self, seconds):
+        """休眠至多seconds秒，期间有新文件出现或文件写完则提前返回"""
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self.poll(timeout=int(remaining * 1000)):
+                return
+
+
+class Sha1Cache:
+    """基于SQLite持久化的SHA1缓存与尝试次数，SHA1按(路径, 大小, mtime_ns)命中，进程重启后仍有效"""
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sha1_cache("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha1 TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0, xxh INTEGER)"
+        )
+        # 兼容旧版本创建的缓存库（无快速指纹列）
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sha1_cache)")}
+        if "xxh" not in columns:
+            self.conn.execute("ALTER TABLE sha1_cache ADD COLUMN xxh INTEGER")
+        self.conn.commit()
+
+    def get_sha1(self, path, size, mtime_ns):
+        """大小与修改时间均未变化时返回缓存的SHA1，否则返回None"""
+        row = self.conn.execute(
+            "SELECT sha1 FROM sha1_cache WHERE path=? AND size=? AND mtime_ns=?",
+            (path, size, mtime_ns),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_sha1_by_fingerprint(self, path, size, mtime_ns, xxh):
+        """仅修改时间变化但大小与快速指纹一致时，刷新修改时间并返回缓存的SHA1，否则返回None"""
+        with self.conn:
+            row = self.conn.execute(
+                "UPDATE sha1_cache SET mtime_ns=? WHERE path=? AND size=? AND xxh=? RETURNING sha1",
+                (mtime_ns, path, size, xxh),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_sha1(self, path, size, mtime_ns, sha1, xxh):
+        """写入SHA1；同一路径上已换成另一个文件（大小或快速指纹不同）时尝试次数清零"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO sha1_cache(path, size, mtime_ns, sha1, xxh) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "attempts=CASE WHEN size IS NULL OR (size=excluded.size AND xxh IS excluded.xxh) "
+                "THEN attempts ELSE 0 END, "
+                "size=excluded.size, mtime_ns=excluded.mtime_ns, sha1=excluded.sha1, xxh=excluded.xxh",
+                (path, size, mtime_ns, sha1, xxh),
+            )
+
+    def add_attempt(self, path):
+        """尝试次数加一，返回累计次数"""
+        with self.conn:
+            return self.conn.execute(
+                "INSERT INTO sha1_cache(path, attempts) VALUES (?, 1) "
+                "ON CONFLICT(path) DO UPDATE SET attempts=attempts+1 RETURNING attempts",
+                (path,),
+            ).fetchone()[0]
+
+    def forget(self, path):
+        """删除文件对应的缓存记录（秒传成功、移走或文件已删除时）"""
+        with self.conn:
+            self.conn.execute("DELETE FROM sha1_cache WHERE path=?", (path,))
+
+    def prune(self, existing_paths):
+        """以全量扫描结果删除已不存在文件的记录（文件在外部被删除或改名时）"""
+        existing = set(existing_paths)
+        stale = [(path,) for (path,) in self.conn.execute("SELECT path FROM sha1_cache") if path not in existing]
+        if stale:
+            with self.conn:
+                self.conn.executemany("DELETE FROM sha1_cache WHERE path=?", stale)
+
+
+def lookup_cached_sha1(cache, file_path, size, mtime_ns):
+    """查询缓存的SHA1，返回(SHA1或None, 快速指纹)"""
+    sha1 = cache.get_sha1(file_path, size, mtime_ns)
+    if sha1:
+        return sha1, None
+    # 仅修改时间变化（如rsync/mv）时，快速指纹一致即可沿用缓存的SHA1，无需完整计算
+    fingerprint = quick_fingerprint(file_path)
+    sha1 = cache.get_sha1_by_fingerprint(file_path, size, mtime_ns, fingerprint)
+    if sha1:
+        logger.info("文件快速指纹未变：%s", file_path)
+    return sha1, fingerprint
+
+
+@dataclass(slots=True)
+class PrefetchedSha1:
+    """后台计算中的SHA1，仅当文件大小与修改时间仍与提交时一致才可使用"""
+    size: int
+    mtime_ns: int
+    future: Future
+
+    def matches(self, stat):
+        return (self.size, self.mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+
+
+def prefetch_sha1(executor, prefetched, cache, file_path, use_mmap):
+    """缓存未命中时提前在线程池中计算SHA1，结果记录到prefetched：{文件路径: PrefetchedSha1}"""
+    if file_path in prefetched:
+        return
+    try:
+        stat = os.stat(file_path)
+        if lookup_cached_sha1(cache, file_path, stat.st_size, stat.st_mtime_ns)[0]:
+            return
+    except OSError:
+        return
+    future = executor.submit(sha1_file, file_path, use_mmap)
+    prefetched[file_path] = PrefetchedSha1(stat.st_size, stat.st_mtime_ns, future)
+
+
+def get_status_code(exc):
+    """从异常中提取HTTP状态码，没有则返回None"""
+    response = getattr(exc, "response", None)
+    for status in (getattr(response, "status_code", None), getattr(exc, "status_code", None), getattr(exc, "status", None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_auth_error(exc):
+    """判断异常是否由cookies失效等认证问题引起（仅此类错误需要重新初始化客户端）"""
+    return isinstance(exc, AuthenticationError) or get_status_code(exc) in (401, 403)
+
+
+def warm_sha1_cache(executor, prefetched, cache, watcher, file_paths):
+    """启动时将积压文件缺失的SHA1全部提交到线程池并行计算（hashlib计算时释放GIL），主循环按顺序取用，无需等待全部算完"""
+    for file_path in file_paths:
+        # 跳过可能仍在写入的文件
+        if is_write_finished(watcher, file_path):
+            prefetch_sha1(executor, prefetched, cache, file_path, can_mmap(watcher, file_path))
+    if prefetched:
+        logger.info("已提交 %s 个文件的SHA1后台并行计算", len(prefetched))
+
+
+def init_115_client(cookies):
     """初始化115客户端（cookies认证）"""
     try:
-        client = P115Client(COOKIES)
-        print("[信息] 客户端初始化成功（cookies有效）")
+        client = P115Client(cookies)
+        logger.info("客户端初始化成功（cookies有效）")
         return client
     except Exception as e:
-        print(f"[错误] 客户端初始化失败（检查cookies是否有效）：{e}")
+        logger.error("客户端初始化失败（检查cookies是否有效）：%s", e)
         raise
 
 class TelegramNotifier:
@@ -64,18 +460,55 @@ class TelegramNotifier:
         self.bot_token = bot_token
         self.user_id = user_id
         self.base_url = f"https://api.telegram.org/bot{self.bot_token}/" if self.bot_token else None
+        self.session = requests.Session()  # 复用连接，避免每条消息重新TLS握手
+        self.queue = queue.Queue()
+        self.pending = []  # 本轮待合并发送的消息
+        if self.bot_token:
+            # 后台线程发送消息，Telegram响应慢或不可用时不阻塞上传主循环
+            threading.Thread(target=self._worker, name="telegram-notifier", daemon=True).start()
 
     def send_message(self, message):
-        """向指定用户发送消息，若bot_token未设置则跳过发送"""
+        """将消息放入发送队列，由后台线程发送给指定用户，若bot_token未设置则跳过发送"""
         # 检查bot_token是否存在
         if not self.bot_token:
-            print("未设置bot_token，跳过发送消息")
+            logger.info("未设置bot_token，跳过发送消息")
             return False
 
         if not message:
-            print("警告：消息内容不能为空")
+            logger.warning("消息内容不能为空")
             return False
 
+        self.queue.put(message)
+        return True
+
+    def enqueue(self, message):
+        """暂存消息，等待flush()时与本轮其他消息合并为一条发送"""
+        if self.bot_token and message:
+            self.pending.append(message)
+
+    def flush(self):
+        """将暂存的消息按行合并发送（单条不超过Telegram的4096字符上限），并清空暂存"""
+        batch = ""
+        for message in self.pending:
+            if batch and len(batch) + 1 + len(message) > TG_MESSAGE_MAX_LEN:
+                self.send_message(batch)
+                batch = ""
+            batch = f"{batch}\n{message}" if batch else message
+        if batch:
+            self.send_message(batch)
+        self.pending.clear()
+
+    def _worker(self):
+        """后台线程：逐条发送队列中的消息"""
+        while True:
+            message = self.queue.get()
+            try:
+                self._send(message)
+            except Exception as e:
+                logger.error("发送消息给用户 %s 时发生未知错误: %s", self.user_id, e)
+
+    def _send(self, message):
+        """向指定用户发送消息"""
         success_count = 0
         fail_count = 0
 
@@ -85,99 +518,161 @@ class TelegramNotifier:
         }
 
         try:
-            response = requests.get(f"{self.base_url}sendMessage", params=params)
+            response = self.session.get(f"{self.base_url}sendMessage", params=params, timeout=10)
             response.raise_for_status()
 
             result = response.json()
             if result.get("ok", False):
-                print(f"消息已成功发送给用户 {self.user_id}")
+                logger.info("消息已成功发送给用户 %s", self.user_id)
                 success_count += 1
             else:
-                print(f"发送消息给用户 {self.user_id} 失败: {result.get('description', '未知错误')}")
+                logger.error("发送消息给用户 %s 失败: %s", self.user_id, result.get('description', '未知错误'))
                 fail_count += 1
 
         except requests.exceptions.RequestException as e:
-            print(f"发送消息给用户 {self.user_id} 时发生错误: {str(e)}")
+            logger.error("发送消息给用户 %s 时发生错误: %s", self.user_id, e)
             fail_count += 1
 
-        print(f"消息发送完成 - 成功: {success_count}, 失败: {fail_count}")
+        logger.info("消息发送完成 - 成功: %s, 失败: %s", success_count, fail_count)
         return success_count > 0
 
 # ======================== 核心逻辑 ========================
-def main():
+def main(cfg):
     # 初始化Telegram通知器
-    notifier = TelegramNotifier(TG_BOT_TOKEN, TG_ADMIN_USER_ID)
+    notifier = TelegramNotifier(cfg.tg_bot_token, cfg.tg_admin_user_id)
     
     # 发送启动通知（如果配置了Telegram）
-    if TG_BOT_TOKEN and TG_ADMIN_USER_ID:
+    if cfg.tg_enabled:
         notifier.send_message(f"ptto115：开始监控待上传目录，当前版本 {version}")
-    cache = {}  # 内存缓存：{文件绝对路径: SHA1}
-    attempt_count = {}  # 跟踪每个文件的尝试次数：{文件绝对路径: 次数}
-    client = init_115_client()
+    cache = Sha1Cache(CACHE_DB_PATH)  # 持久化缓存：{文件绝对路径: (大小, mtime_ns, SHA1, 尝试次数)}
+    client = init_115_client(cfg.cookies)
+    backoff = RETRY_BACKOFF_MIN  # 上传接口连续失败时的退避时间
     last_delete_time = time.time()
     
     # 确保transfer目录存在
-    transfer_dir = os.path.join(os.path.dirname(__file__), "transfer")
-    if not os.path.exists(transfer_dir):
-        os.makedirs(transfer_dir)
-        print(f"[信息] 创建transfer目录：{transfer_dir}")
-
-    while True:
-        print(f"[信息] 开始遍历待上传目录，当前版本 {version}...")
-        # 遍历upload目录文件
-        for root, _, files in os.walk(UPLOAD_DIR):
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                file_key = file_path
-
-                print(f"[信息] 正在检查文件 {file_path} 的大小稳定性...")
-                # 检查文件大小稳定性
-                if not check_file_size_stability(file_path):
-                    continue
+    if not os.path.exists(TRANSFER_DIR):
+        os.makedirs(TRANSFER_DIR)
+        logger.info("创建transfer目录：%s", TRANSFER_DIR)
+
+    # 初始化inotify目录监控（网络文件系统或inotify不可用时回退为文件大小检查）
+    watcher = None
+    if is_network_fs(UPLOAD_DIR):
+        logger.info("待上传目录位于网络文件系统，使用文件大小检查判断文件是否写完：%s", UPLOAD_DIR)
+    else:
+        try:
+            watcher = UploadDirWatcher(UPLOAD_DIR)
+            logger.info("已启用inotify目录监控：%s", UPLOAD_DIR)
+        except OSError as e:
+            logger.warning("inotify初始化失败，使用文件大小检查判断文件是否写完：%s", e)
+
+    # 后台计算SHA1：启动时并行计算积压文件，之后预取下一个文件，与当前文件的秒传请求及休眠重叠执行
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    prefetched = {}  # {文件路径: PrefetchedSha1}
+
+    # 预先并行计算积压文件的SHA1，避免第一轮逐个串行计算
+    if watcher is not None:
+        backlog = sorted(watcher.files)
+    else:
+        backlog = [entry.path for entry in iter_files(UPLOAD_DIR)]
+    cache.prune(backlog)
+    warm_sha1_cache(executor, prefetched, cache, watcher, backlog)
+    last_full_scan = time.monotonic()  # 监控器初始化时已扫描过一次
+
+    try:
+        while True:
+            logger.info("开始遍历待上传目录，当前版本 %s...", version)
+            # 启用inotify时直接使用监控器维护的文件列表，仅在事件丢失或定期校正时全量扫描upload目录
+            if watcher is None or watcher.needs_rescan or time.monotonic() - last_full_scan >= FULL_RESCAN_INTERVAL:
+                file_paths = [entry.path for entry in iter_files(UPLOAD_DIR)]
+                cache.prune(file_paths)
+                if watcher is not None:
+                    watcher.reconcile(file_paths)
+                    last_full_scan = time.monotonic()
+            else:
+                watcher.poll()
+                file_paths = sorted(watcher.files)
+            for index, file_path in enumerate(file_paths):
+                # 下一个文件无需等待即可确认写完时（含无inotify时积压的旧文件），提前计算其SHA1
+                if index + 1 < len(file_paths) and is_write_finished(watcher, file_paths[index + 1]):
+                    next_path = file_paths[index + 1]
+                    prefetch_sha1(executor, prefetched, cache, next_path, can_mmap(watcher, next_path))
+
+                filename = os.path.basename(file_path)
+
+                # 检查文件是否已写完
+                if watcher is not None:
+                    watcher.poll()
+                    if file_path in watcher.writing:
+                        try:
+                            idle = is_idle(os.stat(file_path).st_mtime)
+                        except OSError:
+                            idle = False
+                        if not idle:
+                            logger.info("文件正在写入，跳过：%s", file_path)
+                            continue
+                        # 长时间未修改却一直未收到关闭事件（如写入方持有文件句柄不关闭），改用文件大小检查
+                        watcher.writing.discard(file_path)
+                if watcher is None or file_path not in watcher.completed:
+                    # inotify未记录到该文件写完（启动前已存在或位于网络挂载），回退为文件大小检查
+                    logger.info("正在检查文件 %s 的大小稳定性...", file_path)
+                    if not is_file_size_stable(file_path):
+                        continue
 
                 # 获取文件大小
                 try:
-                    filesize = os.path.getsize(file_path)
-                    print(f"[信息] 获取到文件 {file_path} 的大小为 {filesize} 字节")
+                    stat = os.stat(file_path)
+                    filesize = stat.st_size
+                    logger.info("获取到文件 %s 的大小为 %s 字节", file_path, filesize)
                 except FileNotFoundError:
-                    print(f"[信息] 文件已删除：{file_path}")
-                    if file_key in cache:
-                        del cache[file_key]
+                    logger.info("文件已删除：%s", file_path)
+                    cache.forget(file_path)
+                    continue
+
+                # 检查缓存中是否有哈希值（大小或修改时间变化后缓存失效），未命中时本地计算一次并缓存
+                # 先于尝试次数处理：同一路径换成另一个文件时，set_sha1会将尝试次数清零
+                try:
+                    filesha1, fingerprint = lookup_cached_sha1(cache, file_path, filesize, stat.st_mtime_ns)
+                    if filesha1:
+                        logger.info("使用缓存的SHA1值：%s → %s", file_path, filesha1)
+                    else:
+                        prefetch = prefetched.pop(file_path, None)
+                        if prefetch is not None and prefetch.matches(stat):
+                            logger.info("等待后台SHA1计算完成：%s", file_path)
+                            filesha1 = prefetch.future.result()
+                        else:
+                            logger.info("缓存中无SHA1值，正在计算：%s", file_path)
+                            filesha1 = sha1_file(file_path, use_mmap=can_mmap(watcher, file_path))
+                        cache.set_sha1(file_path, filesize, stat.st_mtime_ns, filesha1, fingerprint)
+                        logger.info("已缓存文件哈希值：%s → %s", file_path, filesha1)
+                except FileNotFoundError:
+                    logger.info("文件已删除：%s", file_path)
+                    cache.forget(file_path)
+                    continue
+                except OSError as e:
+                    logger.error("计算SHA1失败：%s → %s", file_path, e)
                     continue
 
-                # 检查缓存中是否有哈希值
-                cached_sha1 = cache.get(file_key)
-                if cached_sha1:
-                    print(f"[信息] 使用缓存的SHA1值：{file_path} → {cached_sha1}")
-                else:
-                    print(f"[信息] 缓存中无SHA1值，将通过上传接口自动计算")
-
-                # 初始化文件尝试次数
-                if file_key not in attempt_count:
-                    attempt_count[file_key] = 0
-                
                 # 增加尝试次数
-                attempt_count[file_key] += 1
-                print(f"[信息] 正在尝试上传文件（第 {attempt_count[file_key]}/{TRY_MAX_COUNT} 次）：{file_path}")
-                
+                attempts = cache.add_attempt(file_path)
+                logger.info("正在尝试上传文件（第 %s/%s 次）：%s", attempts, cfg.try_max_count, file_path)
+            
                 # 检查是否达到最大尝试次数
-                if attempt_count[file_key] > TRY_MAX_COUNT:
+                if attempts > cfg.try_max_count:
                     # 移动文件到transfer目录
-                    transfer_path = os.path.join(os.path.dirname(__file__), "transfer", filename)
+                    transfer_path = os.path.join(TRANSFER_DIR, filename)
                     try:
-                        os.rename(file_path, transfer_path)
-                        print(f"[信息] 已将文件移动到transfer目录：{file_path} -> {transfer_path}")
+                        # shutil.move先尝试rename（同一文件系统时仅修改目录项），跨设备（含Docker中
+                        # 同一文件系统的不同bind mount）rename报EXDEV时回退为复制后删除，复制走sendfile零拷贝
+                        shutil.move(file_path, transfer_path)
+                        logger.info("已将文件移动到transfer目录：%s -> %s", file_path, transfer_path)
                         # 发送失败通知（如果配置了Telegram）
-                        if TG_BOT_TOKEN and TG_ADMIN_USER_ID:
-                            notifier.send_message(f"ptto115：文件“{filename}”尝试上传 {TRY_MAX_COUNT} 次失败，已移动到transfer目录")
-                        if file_key in cache:
-                            del cache[file_key]
-                        if file_key in attempt_count:
-                            del attempt_count[file_key]
+                        if cfg.tg_enabled:
+                            notifier.enqueue(f"ptto115：文件“{filename}”尝试上传 {cfg.try_max_count} 次失败，已移动到transfer目录")
+                        cache.forget(file_path)
                     except Exception as e:
-                        print(f"[错误] 移动文件到transfer目录失败：{e}")
+                        logger.error("移动文件到transfer目录失败：%s", e)
                     continue
-                
+
                 # 调用秒传接口（使用环境变量配置的PID）
                 try:
                     upload_result = multipart_upload_init(
@@ -185,45 +680,63 @@ def main():
                         path=file_path,
                         filename=filename,
                         filesize=filesize,
-                        filesha1=cached_sha1 or '',  # 使用缓存的哈希值或留空让接口自动计算
-                        pid=UPLOAD_TARGET_PID
+                        filesha1=filesha1,  # 传入本地计算的哈希值，避免接口内部重复读取整个文件
+                        pid=cfg.upload_pid
                     )
 
                     # 处理秒传结果
                     if "status" in upload_result:
-                        print(f"[成功] 秒传成功：{file_path}（目标目录ID：{UPLOAD_TARGET_PID}）")
+                        logger.info("秒传成功：%s（目标目录ID：%s）", file_path, cfg.upload_pid)
                         # 发送成功通知（如果配置了Telegram）
-                        if TG_BOT_TOKEN and TG_ADMIN_USER_ID:
-                            notifier.send_message(f"ptto115：文件“{filename}”秒传成功")
+                        if cfg.tg_enabled:
+                            notifier.enqueue(f"ptto115：文件“{filename}”秒传成功")
                         os.remove(file_path)
-                        print(f"[信息] 已删除本地文件：{file_path}")
-                        if file_key in cache:
-                            del cache[file_key]
-                        if file_key in attempt_count:
-                            del attempt_count[file_key]
+                        logger.info("已删除本地文件：%s", file_path)
+                        cache.forget(file_path)
                     else:
-                        print(f"[失败] 秒传未成功：{file_path}，从上传配置信息里获取哈希值并缓存")
-                        # 从上传配置信息里获取哈希值
-                        filesha1 = upload_result.get('filesha1', '')
-                        if filesha1:
-                            cache[file_key] = filesha1
-                            print(f"[信息] 已缓存文件哈希值：{file_path} → {filesha1}")
+                        logger.warning("秒传未成功：%s", file_path)
 
+                    backoff = RETRY_BACKOFF_MIN
                 except Exception as e:
-                    print(f"[错误] 上传失败,尝试重新初始化客户端：{file_path} → {e}")
-                    client = init_115_client()
+                    if is_auth_error(e):
+                        logger.error("上传失败（认证失效），尝试重新初始化客户端：%s → %s", file_path, e)
+                        client = init_115_client(cfg.cookies)
+                    else:
+                        # 网络波动、限流或服务端错误：沿用当前客户端，指数退避后继续
+                        logger.error("上传失败，%s 秒后继续：%s → %s", backoff, file_path, e)
+                        time.sleep(backoff)
+                        backoff = min(RETRY_BACKOFF_MAX, backoff * 2)
 
-                #print(f"[信息] 单个文件处理完成，休眠 {SLEEP_AFTER_FILE} 秒...")
+                #logger.info("单个文件处理完成，休眠 %s 秒...", SLEEP_AFTER_FILE)
                 time.sleep(SLEEP_AFTER_FILE)
 
-        print(f"[信息] 一轮遍历完成，休眠 {SLEEP_AFTER_ROUND} 秒...")
-        time.sleep(SLEEP_AFTER_ROUND)
+            # 丢弃本轮未被使用的预取结果（文件已跳过或被移走）
+            for prefetch in prefetched.values():
+                prefetch.future.cancel()
+            prefetched.clear()
+
+            # 本轮产生的通知合并为一条发送
+            notifier.flush()
+
+            if watcher is not None:
+                # 有待处理文件时按轮次重试；目录为空时等待inotify事件，至多到下一次全量扫描
+                sleep_seconds = SLEEP_AFTER_ROUND if watcher.files else FULL_RESCAN_INTERVAL
+                logger.info("一轮遍历完成，休眠 %s 秒（有新文件出现或写完时提前开始）...", sleep_seconds)
+                watcher.wait(sleep_seconds)
+            else:
+                logger.info("一轮遍历完成，休眠 %s 秒...", SLEEP_AFTER_ROUND)
+                time.sleep(SLEEP_AFTER_ROUND)
+    finally:
+        # 退出（含Ctrl-C）时取消排队中的SHA1计算，不必等待积压文件全部算完
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    config = load_config()
     try:
-        main()
+        main(config)
     except KeyboardInterrupt:
-        print("\n[信息] 用户终止程序")
+        logger.info("用户终止程序")
     except Exception as e:
-        print(f"[错误] 程序异常：{e}")
\ No newline at end of file
+        logger.exception("程序异常：%s", e)
\ No newline at end of file